@@ -1,14 +1,19 @@
 # explain_lines.py
-import ast, sys, json, runpy, types, argparse, io, contextlib, linecache, builtins, time
-import tkinter as tk
-from tkinter import filedialog
-import subprocess, textwrap, shutil
-from trace import Trace
+import ast, sys, json, re, runpy, io, contextlib, collections, builtins, time
+import functools, hashlib, os, tokenize
+# tkinter, trace, asyncio and httpx are imported where they are
+# used, so programmatic callers of explain_file don't pay for GUI/LLM code
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is the fallback
+    orjson = None
 
 def browse_files():
     """
     Opens a file selection dialog and returns the selected file's path.
     """
+    from tkinter import filedialog
+
     filename = filedialog.askopenfilename(
         title="Select a File",
         initialdir="/",  # Start directory (use "C:\\" for Windows root)
@@ -23,50 +28,178 @@ def browse_files():
 
 
 def read_file(path):
-    with open(path, "r", encoding="utf-8") as f:
+    """
+    Return the file's raw bytes: ast.parse takes them directly, so skip
+    TextIOWrapper's decode + newline translation pass.
+    """
+    with open(path, "rb") as f:
         return f.read()
 
-def ast_facts(src):
-    tree = ast.parse(src)
-    facts = {}  # line -> list of strings
-    for node in ast.walk(tree):
-        ln = getattr(node, "lineno", None)
-        if not isinstance(ln, int): continue
-        items = facts.setdefault(ln, [])
-        if isinstance(node, ast.Assign):
-            targets = [ast.unparse(t) if hasattr(ast, "unparse") else type(t).__name__ for t in node.targets]
-            items.append(f"assign: {', '.join(targets)} = {ast.get_source_segment(src, node.value) or '...'}")
-        elif isinstance(node, ast.AugAssign):
-            items.append(f"augassign: {ast.get_source_segment(src, node.target)} {type(node.op).__name__}= {ast.get_source_segment(src, node.value)}")
-        elif isinstance(node, ast.Call):
-            callee = ast.get_source_segment(src, node.func) or 'call'
-            items.append(f"call: {callee}(...)")
-        elif isinstance(node, ast.Return):
-            items.append(f"return: {ast.get_source_segment(src, node.value) if node.value else 'None'}")
-        elif isinstance(node, ast.If):
-            test = ast.get_source_segment(src, node.test)
-            items.append(f"branch-if: {test}")
-        elif isinstance(node, ast.For):
-            it = ast.get_source_segment(src, node.iter)
-            tgt = ast.get_source_segment(src, node.target)
-            items.append(f"loop-for: {tgt} in {it}")
-        elif isinstance(node, ast.While):
-            items.append("loop-while: condition")
-        elif isinstance(node, ast.Import):
-            names = ", ".join([a.name for a in node.names])
-            items.append(f"import: {names}")
-        elif isinstance(node, ast.ImportFrom):
-            mod = node.module or "."
-            names = ", ".join([a.name for a in node.names])
-            items.append(f"from {mod} import {names}")
-        elif isinstance(node, ast.With):
-            items.append("with: context manager")
-        elif isinstance(node, ast.FunctionDef):
-            args = [a.arg for a in node.args.args]
-            items.append(f"def: {node.name}({', '.join(args)})")
-        elif isinstance(node, ast.ClassDef):
-            items.append(f"class: {node.name}")
-    return facts
+def parse_source(src):
+    return ast.parse(src)
+
+@functools.lru_cache(maxsize=64)
+def _load_source_cached(path, mtime_ns, size):
+    data = read_file(path)
+    tree = parse_source(data)
+    # decode the way ast.parse just did: PEP 263 cookie, BOM, else utf-8
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    return data.decode(encoding), tree
+
+def load_source(path):
+    """
+    Read and parse `path` once; repeat calls reuse the (src, tree) pair
+    until the file's mtime or size changes.
+    """
+    path = _realpath(path)
+    st = os.stat(path)
+    return _load_source_cached(path, st.st_mtime_ns, st.st_size)
+
+def expr_text(node):
+    """
+    Source text for an expression. Bare names and dotted name chains (the
+    usual call targets and assignment targets) are built directly instead
+    of going through ast.unparse.
+    """
+    parts = []
+    cur = node
+    while isinstance(cur, ast.Attribute):
+        parts.append(cur.attr)
+        cur = cur.value
+    if not isinstance(cur, ast.Name):
+        return ast.unparse(node)
+    parts.append(cur.id)
+    return ".".join(reversed(parts))
+
+# Node types that never contain a fact-bearing node (names, literals,
+# contexts, operators, import aliases); FactCollector doesn't descend into them.
+LEAF_TYPES = frozenset(
+    [ast.Name, ast.Constant, ast.alias]
+    + [t for base in (ast.expr_context, ast.operator, ast.boolop, ast.unaryop, ast.cmpop)
+       for t in base.__subclasses__()]
+)
+
+class FactCollector(ast.NodeVisitor):
+    """
+    Collects per-line facts. Only the statement/call types below get a
+    visit_* method; every other node falls through to generic_visit.
+    """
+    def __init__(self):
+        self.facts = {}  # line -> list of (depth, string)
+        self.depth = 0
+
+    def _add(self, node, fact):
+        self.facts.setdefault(node.lineno, []).append((self.depth, fact))
+
+    def generic_visit(self, node):
+        self.depth += 1
+        for child in ast.iter_child_nodes(node):
+            if type(child) not in LEAF_TYPES:
+                self.visit(child)
+        self.depth -= 1
+
+    def line_facts(self):
+        """
+        Facts per line in ast.walk (breadth-first) order: same-depth nodes
+        already arrive in that order, so a stable sort on depth is enough.
+        """
+        return {ln: [f for _, f in sorted(items, key=lambda it: it[0])]
+                for ln, items in self.facts.items()}
+
+    def visit_Assign(self, node):
+        targets = [expr_text(t) for t in node.targets]
+        self._add(node, f"assign: {', '.join(targets)} = {ast.unparse(node.value) or '...'}")
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        self._add(node, f"augassign: {expr_text(node.target)} {type(node.op).__name__}= {ast.unparse(node.value)}")
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        callee = expr_text(node.func) or 'call'
+        self._add(node, f"call: {callee}(...)")
+        self.generic_visit(node)
+
+    def visit_Return(self, node):
+        self._add(node, f"return: {ast.unparse(node.value) if node.value else 'None'}")
+        self.generic_visit(node)
+
+    def visit_If(self, node):
+        test = ast.unparse(node.test)
+        self._add(node, f"branch-if: {test}")
+        self.generic_visit(node)
+
+    def visit_For(self, node):
+        it = ast.unparse(node.iter)
+        tgt = expr_text(node.target)
+        self._add(node, f"loop-for: {tgt} in {it}")
+        self.generic_visit(node)
+
+    def visit_While(self, node):
+        self._add(node, "loop-while: condition")
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        names = ", ".join([a.name for a in node.names])
+        self._add(node, f"import: {names}")
+
+    def visit_ImportFrom(self, node):
+        mod = node.module or "."
+        names = ", ".join([a.name for a in node.names])
+        self._add(node, f"from {mod} import {names}")
+
+    def visit_With(self, node):
+        self._add(node, "with: context manager")
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        args = [a.arg for a in node.args.args]
+        self._add(node, f"def: {node.name}({', '.join(args)})")
+        self.generic_visit(node)
+
+    def visit_ClassDef(self, node):
+        self._add(node, f"class: {node.name}")
+        self.generic_visit(node)
+
+def ast_facts(tree):
+    collector = FactCollector()
+    collector.visit(tree)
+    return collector.line_facts()
+
+class TailBuffer(io.TextIOBase):
+    """
+    Write-only text sink that keeps just the last `max_lines` lines, and the
+    last `max_line_chars` characters of a line still being written, so a
+    chatty traced program can't grow the captured output without bound.
+    """
+    def __init__(self, max_lines=10_000, max_line_chars=65_536):
+        self.buf = collections.deque(maxlen=max_lines)
+        self.max_line_chars = max_line_chars
+        self._partial = []  # pieces of the current, unterminated line
+        self._partial_len = 0
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        self._partial.append(s)
+        self._partial_len += len(s)
+        if "\n" in s:
+            parts = "".join(self._partial).split("\n")
+            tail = parts.pop()
+            self._partial = [tail]
+            self._partial_len = len(tail)
+            self.buf.extend(parts)
+        if self._partial_len > 2 * self.max_line_chars:
+            # end="" loops and \r progress bars never send a newline; keep
+            # only the line's tail (trimmed at 2x to amortize the join)
+            tail = "".join(self._partial)[-self.max_line_chars:]
+            self._partial = [tail]
+            self._partial_len = len(tail)
+        return len(s)
+
+    def getvalue(self):
+        return "\n".join([*self.buf, "".join(self._partial)])
 
 def run_with_trace(path, entry=None, args=None, kwargs=None, stdin_data=""):
     """
@@ -96,9 +229,7 @@ def run_with_trace(path, entry=None, args=None, kwargs=None, stdin_data=""):
         original_sleep(min(float(s), 0.01))
 
     # 3) Trace only the entry call
-    tracer = Trace(count=True, trace=False, ignoremods=set())
-
-    out_buf = io.StringIO()
+    out_buf = TailBuffer()
     try:
         builtins.input = stub_input
         time.sleep = fast_sleep
@@ -106,44 +237,104 @@ def run_with_trace(path, entry=None, args=None, kwargs=None, stdin_data=""):
         if entry:
             func = globs.get(entry)
             if not callable(func):
-                counts = {}
                 return {}, ""
             with contextlib.redirect_stdout(out_buf), contextlib.redirect_stderr(out_buf), contextlib.redirect_stdin(fake_stdin):
-                tracer.runfunc(func, *args, **kwargs)
+                counts = count_line_hits(path, func, *args, **kwargs)
         else:
-            counts = {}
             return {}, out_buf.getvalue()
 
     finally:
         builtins.input = original_input
         time.sleep = original_sleep
 
-    results = tracer.results()
-    counts = {ln: hits for (fname, ln), hits in results.counts.items() if fname.endswith(path)}
     return counts, out_buf.getvalue()
 
+@functools.lru_cache(maxsize=None)
+def _realpath(fname):
+    return os.path.realpath(fname)
+
+def _trace_line_hits(abspath, func, args, kwargs):
+    # stdlib/site-packages lines are never recorded, so results stay
+    # proportional to the target file instead of everything executed; in a
+    # virtualenv the stdlib lives under the base prefixes
+    prefixes = {sys.prefix, sys.exec_prefix, sys.base_prefix, sys.base_exec_prefix}
+    ignored = [d for d in prefixes if not abspath.startswith(d + os.sep)]
+    from trace import Trace
+    tracer = Trace(count=True, trace=False, ignoredirs=ignored)
+    tracer.runfunc(func, *args, **kwargs)
+    results = tracer.results()
+    return {ln: hits for (fname, ln), hits in results.counts.items() if _realpath(fname) == abspath}
+
+def _claim_tool_id(mon):
+    """
+    Claim a free sys.monitoring tool id, preferring PROFILER_ID (taken e.g.
+    under cProfile on 3.12+); 3 and 4 have no reserved use. None if all are busy.
+    """
+    for tool in (mon.PROFILER_ID, 3, 4):
+        if mon.get_tool(tool) is None:
+            try:
+                mon.use_tool_id(tool, "code_explainer")
+                return tool
+            except ValueError:  # claimed in between
+                continue
+    return None
+
+def count_line_hits(path, func, *args, **kwargs):
+    """
+    Call func(*args, **kwargs) and return {line: hits} for lines of `path`.
+    Uses sys.monitoring (3.12+) so lines outside `path` are disabled after
+    their first event; falls back to trace.Trace on older interpreters or
+    when no monitoring tool id is free.
+    """
+    abspath = _realpath(path)
+    if not hasattr(sys, "monitoring"):
+        return _trace_line_hits(abspath, func, args, kwargs)
+
+    mon = sys.monitoring
+    tool = _claim_tool_id(mon)
+    if tool is None:
+        return _trace_line_hits(abspath, func, args, kwargs)
+    counts = {}
+
+    def on_line(code, ln):
+        if _realpath(code.co_filename) != abspath:
+            return mon.DISABLE
+        counts[ln] = counts.get(ln, 0) + 1
+
+    try:
+        mon.register_callback(tool, mon.events.LINE, on_line)
+        mon.set_events(tool, mon.events.LINE)
+        func(*args, **kwargs)
+    finally:
+        mon.set_events(tool, mon.events.NO_EVENTS)
+        mon.register_callback(tool, mon.events.LINE, None)
+        mon.free_tool_id(tool)
+    return counts
+
 def explain_file(path, entry=None, args=None, kwargs=None):
-    src = read_file(path)
-    facts = ast_facts(src)
+    src, tree = load_source(path)
+    facts = ast_facts(tree)
     hits, out = run_with_trace(path, entry, args, kwargs)
 
-    # Precompute facts and hits for faster access
-    fact_lines = set(facts.keys())
-    hit_lines = set(hits.keys())
+    # Walk the lines that have facts or hits in order alongside the source,
+    # so each line costs one int compare instead of two set lookups.
+    interesting = iter(sorted(facts.keys() | hits.keys()))
+    nxt = next(interesting, None)
 
     explanations = []
     lines = src.splitlines()
 
     for i, text in enumerate(lines, start=1):
+        line_info = []
+        if i == nxt:
+            line_info.extend(facts.get(i, ()))
+            if i in hits:
+                line_info.append(f"runtime: executed {hits[i]}x")
+            nxt = next(interesting, None)
+
         if not text.strip():
             continue  # Skip blank lines early
 
-        line_info = []
-        if i in fact_lines:
-            line_info.extend(facts[i])
-        if i in hit_lines:
-            line_info.append(f"runtime: executed {hits[i]}x")
-
         if not line_info:
             line_info = ["(no AST events; likely comment/blank or simple expression)"]
 
@@ -157,10 +348,30 @@ def explain_file(path, entry=None, args=None, kwargs=None):
 
 # ---- CONFIG ----
 MODEL = "mymodel:latest"  # Ollama tag
-USE_OLLAMA = shutil.which("ollama") is not None
+# Same OLLAMA_HOST the ollama CLI honors, so a server in Docker or on another
+# host is reachable without a local binary.
+_OLLAMA_HOST = os.environ.get("OLLAMA_HOST") or "localhost:11434"
+if "://" not in _OLLAMA_HOST:
+    _OLLAMA_HOST = f"http://{_OLLAMA_HOST}"
+OLLAMA_URL = f"{_OLLAMA_HOST.rstrip('/')}/api/generate"
+BATCH_SIZE = 20  # source lines per LLM request
+# Concurrent requests from call_local_llm_many are only served in parallel up to
+# the server's slot count; start Ollama with OLLAMA_NUM_PARALLEL=<n> to raise it.
+# We keep at most that many in flight so queued requests don't sit out the
+# read timeout waiting for a slot.
+DEFAULT_PARALLEL = 2
+
+def max_parallel():
+    """OLLAMA_NUM_PARALLEL if it's a positive int, else DEFAULT_PARALLEL."""
+    try:
+        return max(1, int(os.environ.get("OLLAMA_NUM_PARALLEL", "")))
+    except ValueError:
+        return DEFAULT_PARALLEL
+
+CACHE_DIR = os.path.expanduser("~/.cache/code_explainer")
 
 SYSTEM_PROMPT = """You are a code explainer.
-You will be given, for each line: the original code and a list of FACTS derived from AST/runtime.
+You will be given a JSON array of objects, one per line, each with the line number, the original code and a list of FACTS derived from AST/runtime.
 RULES:
 - ONLY restate those facts. Do not invent behavior or values not present in facts.
 - If something is unknown, say 'unknown from provided facts'.
@@ -174,66 +385,296 @@ USER_TEMPLATE = """CODE FACTS:
 Now produce the JSON as specified.
 """
 
-def call_local_llm(prompt):
-    if USE_OLLAMA:
-        retries = 2  # Number of retries
-        for attempt in range(retries + 1):
-            try:
-                # Use Ollama with a longer timeout to prevent hanging
-                proc = subprocess.run(
-                    ["ollama", "run", MODEL],
-                    input=prompt.encode("utf-8"),
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    timeout=600  # Timeout after 60 seconds
-                )
-                if proc.returncode != 0:
-                    print("Error running Ollama:", proc.stderr.decode("utf-8"))
-                    raise RuntimeError("Ollama command failed. Check the error above.")
-                return proc.stdout.decode("utf-8")
-            except subprocess.TimeoutExpired:
-                if attempt < retries:
-                    print(f"Attempt {attempt + 1} failed due to timeout. Retrying...")
-                else:
-                    raise SystemExit("Ollama command timed out after multiple attempts. Ensure the model is available and try again.")
+@functools.lru_cache(maxsize=None)
+def use_ollama():
+    """
+    True if an Ollama server answers at OLLAMA_URL. Everything talks HTTP,
+    so the ollama binary being on PATH is irrelevant.
+    """
+    import urllib.request
+    version_url = OLLAMA_URL.rsplit("/api/", 1)[0] + "/api/version"
+    try:
+        with urllib.request.urlopen(version_url, timeout=2) as resp:
+            return resp.status == 200
+    except (OSError, ValueError):
+        return False
+
+@functools.lru_cache(maxsize=None)
+def _client():
+    import httpx
+    return httpx.Client(timeout=600)  # keep-alive connection reused across calls
+
+def _cache_path(prompt):
+    key = hashlib.blake2b(f"{MODEL}\0{prompt}".encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+def cache_get(prompt):
+    try:
+        with open(_cache_path(prompt), "r", encoding="utf-8") as f:
+            return json.load(f)["response"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def cache_drop(prompt):
+    try:
+        os.remove(_cache_path(prompt))
+    except OSError:
+        pass
+
+def cache_put(prompt, response):
+    """
+    Best-effort: an unwritable cache dir (read-only HOME, containers, CI)
+    just means the response isn't cached.
+    """
+    path = _cache_path(prompt)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"response": response}, f, ensure_ascii=False)
+        os.replace(tmp, path)  # atomic: readers never see a half-written entry
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+_MISS = object()
+
+def _from_cache(prompt, parse):
+    """
+    Cached, already-parsed response for `prompt`, or _MISS. Only checked
+    responses are cached, so without a `parse` there is nothing to reuse;
+    an entry that no longer parses is dropped rather than replayed.
+    """
+    if parse is None:
+        return _MISS
+    raw = cache_get(prompt)
+    if raw is None:
+        return _MISS
+    try:
+        return parse(raw)
+    except ValueError:
+        cache_drop(prompt)
+        return _MISS
+
+def _accept(prompt, response, parse):
+    """Parse a fresh response and only then persist it to the disk cache."""
+    if parse is None:
+        return response
+    value = parse(response)  # raises on malformed output; nothing gets cached
+    cache_put(prompt, response)
+    return value
+
+RETRIES = 2  # extra attempts after a timeout or a cut-off stream
+
+def _request_json(prompt):
+    return {"model": MODEL, "prompt": prompt, "stream": True}
+
+def _report_error(resp):
+    # body must already be read (resp.read() / await resp.aread())
+    print("Error running Ollama:", resp.text)
+    raise RuntimeError("Ollama request failed. Check the error above.")
+
+def _stream_piece(line, pieces):
+    """
+    Decode one NDJSON chunk of a streamed /api/generate reply, append its
+    text to `pieces`, and return True once the server reports it is done.
+    """
+    chunk = json_loads(line)
+    if "error" in chunk:
+        print("Error running Ollama:", chunk["error"])
+        raise RuntimeError("Ollama request failed. Check the error above.")
+    pieces.append(chunk.get("response", ""))
+    return chunk.get("done", False)
+
+def _stream_text(pieces, done):
+    if not done:
+        raise ConnectionError("Ollama stream ended before the reply was done.")
+    return "".join(pieces)
+
+def _retry_or_exit(exc, attempt):
+    """
+    Shared by the sync and async paths: return (after a notice) when the
+    failed attempt is worth retrying, raise SystemExit with a user-facing
+    message when it isn't, and re-raise anything unexpected.
+    """
+    import httpx
+    if isinstance(exc, httpx.ConnectError):
+        raise SystemExit(f"Could not connect to Ollama at {OLLAMA_URL}. Start it with 'ollama serve' and retry.")
+    if isinstance(exc, httpx.TimeoutException):
+        what = "failed due to timeout"
+        final = "Ollama request timed out after multiple attempts. Ensure the model is available and try again."
+    elif isinstance(exc, (ConnectionError, httpx.ReadError, httpx.RemoteProtocolError)):
+        # stream cut off mid-reply (dropped connection, server restart)
+        what = "ended before the reply was complete"
+        final = "Ollama reply was cut off after multiple attempts. Ensure the server is stable and try again."
     else:
-        raise SystemExit("No local LLM runner found (expected Ollama). Install and retry.")
+        raise exc
+    if attempt >= RETRIES:
+        raise SystemExit(final)
+    print(f"Attempt {attempt + 1} {what}. Retrying...")
+
+@functools.lru_cache(maxsize=128)
+def call_local_llm(prompt, parse=None):
+    """
+    Run `prompt` through Ollama and return the reply text, or parse(reply)
+    when `parse` is given. Only replies that parse are cached on disk.
+    """
+    cached = _from_cache(prompt, parse)
+    if cached is not _MISS:
+        return cached
+    if not use_ollama():
+        raise SystemExit(f"No Ollama server reachable at {OLLAMA_URL}. Start one (or set OLLAMA_HOST) and retry.")
+    import httpx
+    for attempt in range(RETRIES + 1):
+        try:
+            # Use the Ollama HTTP API with a long timeout to prevent hanging;
+            # streamed, the timeout bounds the gap between tokens, not the
+            # whole generation
+            with _client().stream("POST", OLLAMA_URL, json=_request_json(prompt)) as resp:
+                if resp.is_error:
+                    resp.read()
+                    _report_error(resp)
+                pieces, done = [], False
+                for line in resp.iter_lines():
+                    if line and _stream_piece(line, pieces):
+                        done = True
+                        break
+                text = _stream_text(pieces, done)
+            return _accept(prompt, text, parse)
+        except (httpx.TransportError, ConnectionError) as exc:
+            _retry_or_exit(exc, attempt)
+
+async def _generate_async(client, prompt, slots, parse):
+    import httpx
+    for attempt in range(RETRIES + 1):
+        try:
+            async with slots:
+                async with client.stream("POST", OLLAMA_URL, json=_request_json(prompt)) as resp:
+                    if resp.is_error:
+                        await resp.aread()
+                        _report_error(resp)
+                    pieces, done = [], False
+                    async for line in resp.aiter_lines():
+                        if line and _stream_piece(line, pieces):
+                            done = True
+                            break
+                    text = _stream_text(pieces, done)
+            return _accept(prompt, text, parse)
+        except (httpx.TransportError, ConnectionError) as exc:
+            _retry_or_exit(exc, attempt)
+
+async def call_local_llm_many(prompts, parse=None):
+    """
+    Send several prompts concurrently, at most max_parallel() at a time;
+    responses (or parse(response)) come back in prompt order. Prompts
+    already in the disk cache are not sent.
+    """
+    results = [_from_cache(p, parse) for p in prompts]
+    missing = [i for i, r in enumerate(results) if r is _MISS]
+    if not missing:
+        return results
+    if not use_ollama():
+        raise SystemExit(f"No Ollama server reachable at {OLLAMA_URL}. Start one (or set OLLAMA_HOST) and retry.")
+    import asyncio, httpx
+    slots = asyncio.Semaphore(max_parallel())
+    async with httpx.AsyncClient(timeout=600) as client:
+        fresh = await asyncio.gather(*(_generate_async(client, prompts[i], slots, parse) for i in missing))
+    for i, r in zip(missing, fresh):
+        results[i] = r
+    return results
+
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+def json_loads(s):
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
 
 def build_user_prompt(facts):
-    blocks = []
-    for it in facts:
-        block = {
-            "line": it["line"],
-            "code": it["code"],
-            "facts": it["facts"]
-        }
-        blocks.append(json.dumps(block, ensure_ascii=False))
-    return USER_TEMPLATE.format(items="\n".join(blocks))
+    items = [{"line": it["line"], "code": it["code"], "facts": it["facts"]} for it in facts]
+    return USER_TEMPLATE.format(items=json_dumps(items))
+
+def parse_llm_lines(raw):
+    """
+    Pull the "lines" list out of a model reply; raises ValueError if the
+    reply isn't the JSON object SYSTEM_PROMPT asks for.
+    """
+    # naive clean-up: find first JSON block
+    start = raw.find("{")
+    end = raw.rfind("}")
+    cleaned = raw[start:end+1] if start != -1 and end != -1 else raw
+    data = json_loads(cleaned)  # will raise if malformed; okay—fail loud
+    if not isinstance(data, dict) or not isinstance(data.get("lines"), list):
+        raise ValueError("LLM reply has no \"lines\" list")
+    return data["lines"]
+
+# group n sets bit n-1: executed, risky io/network, dynamic code execution
+PRECHECK_RE = re.compile(r"(runtime: executed)|(writes_to_network|scrape_untrusted)|(execute_code)")
+
+async def explain_with_llm_async(facts):
+    """
+    Explain `facts` (as returned by explain_file) with the LLM; batches are
+    sent concurrently. Async callers should await this directly.
+    """
+    if not use_ollama():
+        # No LLM available: return the facts themselves in the output schema
+        # rather than building prompts that can never be sent.
+        print(f"No Ollama server reachable at {OLLAMA_URL}; returning facts only.", file=sys.stderr)
+        return {"lines": [
+            {"line": it["line"], "explanation": "; ".join(it["facts"]), "red_flags": []}
+            for it in facts
+        ]}
 
-def explain_with_llm(facts):
     # Pre-flagging (deterministic warnings) → append to facts for LLM to surface
     for it in facts:
+        mask = 0
+        for f in it["facts"]:
+            for m in PRECHECK_RE.finditer(f):
+                mask |= 1 << (m.lastindex - 1)
+            if mask == 0b111:
+                break  # every pattern already seen
         ff = []
-        if not any("runtime: executed" in f for f in it["facts"]):
+        if not mask & 0b001:
             ff.append("never_executed_in_trace")
-        if any("writes_to_network" in f or "scrape_untrusted" in f for f in it["facts"]):
+        if mask & 0b010:
             ff.append("risky_io_or_network")
-        if any("execute_code" in f for f in it["facts"]):
+        if mask & 0b100:
             ff.append("dynamic_code_execution")
         if ff:
             it["facts"].append(f"precheck_flags: {','.join(ff)}")
 
-    user = build_user_prompt(facts)
-    full_prompt = f"system\n{SYSTEM_PROMPT}\n\nuser\n{user}\n"
+    # One request per BATCH_SIZE lines keeps each context short and lets the
+    # server overlap the requests instead of running one giant prompt.
+    prompts = []
+    for i in range(0, len(facts), BATCH_SIZE):
+        user = build_user_prompt(facts[i:i + BATCH_SIZE])
+        prompts.append(f"system\n{SYSTEM_PROMPT}\n\nuser\n{user}\n")
 
-    raw = call_local_llm(full_prompt)
-    # naive clean-up: find first JSON block
-    start = raw.find("{")
-    end = raw.rfind("}")
-    cleaned = raw[start:end+1] if start != -1 and end != -1 else raw
-    data = json.loads(cleaned)  # will raise if malformed; okay—fail loud
+    lines = []
+    for batch in await call_local_llm_many(prompts, parse=parse_llm_lines):
+        lines.extend(batch)
 
-    return data
+    return {"lines": lines}
+
+def explain_with_llm(facts):
+    """
+    Sync wrapper around explain_with_llm_async. asyncio.run can't nest, so
+    when called from inside a running event loop (Jupyter, async code) the
+    batches run on a worker thread with their own loop instead.
+    """
+    import asyncio
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(explain_with_llm_async(facts))
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, explain_with_llm_async(facts)).result()
 
 if __name__ == "__main__":
     print("Please select a file to analyze.")